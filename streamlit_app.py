@@ -1,13 +1,75 @@
+import io
+import re
+import asyncio
+import zipfile
 import streamlit as st
 from pypdf import PdfReader
-from trial_matching_agent import WorkflowOrchestrator, TrialDatabase
+from trial_matching_agent import (
+    WorkflowOrchestrator, TrialDatabase, ExtractionDiskCache, REASONING_TEMPLATES, build_llm
+)
 
 st.set_page_config(page_title="Sanofi Agentic Screener", layout="wide")
 
-# Initialize System in Session State (Memory)
-if 'orchestrator' not in st.session_state:
-    st.session_state.orchestrator = WorkflowOrchestrator()
-    st.session_state.db = TrialDatabase()
+# Structured record markers: once every field has been seen, later PDF pages are skipped
+RECORD_FIELDS = {"Patient ID", "Age", "Diagnosis", "Biomarkers", "Medications", "Location"}
+FIELD_RE = re.compile(r"(Patient ID|Age|Diagnosis|Biomarkers|Medications|Location)\s*:")
+
+# pypdfium2 (Apache-2.0) parses an order of magnitude faster than pypdf; PyMuPDF is
+# faster still but AGPL-licensed, so pypdf remains the pure-Python fallback.
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+
+def _iter_pdf_pages(file_bytes: bytes):
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(file_bytes)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                yield textpage.get_text_range()
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+    else:
+        for page in PdfReader(io.BytesIO(file_bytes)).pages:
+            yield page.extract_text() or ""
+
+
+def _extract_pdf_text(file_bytes: bytes) -> str:
+    chunks = []
+    needed = set(RECORD_FIELDS)
+    for page_text in _iter_pdf_pages(file_bytes):
+        chunks.append(page_text)
+        needed -= set(FIELD_RE.findall(page_text))
+        if not needed:
+            break
+    return "\n".join(chunks)
+
+# Shared across all sessions on this server: one Gemini client (and its gRPC channel)
+@st.cache_resource(show_spinner=False)
+def get_llm():
+    return build_llm()
+
+# Trials plus their NumPy index; a resource (not cache_data) so hits aren't re-pickled
+@st.cache_resource(show_spinner=False, ttl=3600)
+def get_trial_db():
+    return TrialDatabase()
+
+# Extractions persisted on disk, so previously seen records skip the LLM after restarts too
+@st.cache_resource(show_spinner=False)
+def get_disk_cache():
+    return ExtractionDiskCache()
+
+# Cheap per-run wrapper; only the in-memory extraction cache is session-scoped, so reruns still hit it
+orchestrator = WorkflowOrchestrator(
+    extraction_cache=st.session_state.setdefault("extraction_cache", {}),
+    db=get_trial_db(),
+    llm=get_llm(),
+    disk_cache=get_disk_cache(),
+)
 
 st.title("🧬 Agentic Clinical Trial Screener (Powered by Gemini)")
 st.markdown("**Zero-Based Process Automation** for Pharma Pipelines")
@@ -19,10 +81,11 @@ with st.sidebar:
     # User chooses how to input data
     input_method = st.radio(
         "Choose Input Method:", 
-        ["Upload PDF", "Simulated Text", "Manual Entry"]
+        ["Upload PDF", "Upload ZIP of PDFs", "Simulated Text", "Manual Entry"]
     )
     
     text_input = "" # This variable will hold the final text sent to AI
+    batch_texts = {} # Bulk screening: file name -> extracted text
 
     # OPTION 1: PDF Upload (The Consumer-Grade Feature)
     if input_method == "Upload PDF":
@@ -31,10 +94,7 @@ with st.sidebar:
         if uploaded_file:
             try:
                 # Read the PDF file
-                pdf = PdfReader(uploaded_file)
-                text_input = ""
-                for page in pdf.pages:
-                    text_input += page.extract_text()
+                text_input = _extract_pdf_text(uploaded_file.getvalue())
                 
                 st.success("✅ PDF Processed Successfully")
                 # Optional: Preview the extracted text
@@ -43,7 +103,37 @@ with st.sidebar:
             except Exception as e:
                 st.error(f"Error reading PDF: {e}")
 
-    # OPTION 2: Simulated Text (Fastest for Demos)
+    # OPTION 2: ZIP of PDFs (Bulk Screening, one batched LLM call per 20 records)
+    elif input_method == "Upload ZIP of PDFs":
+        uploaded_zip = st.file_uploader("Upload Medical Records (ZIP of PDFs)", type="zip")
+        
+        if uploaded_zip:
+            failed = []
+            try:
+                with zipfile.ZipFile(uploaded_zip) as zf:
+                    for info in zf.infolist():
+                        # Skip folders and the resource-fork stubs Finder adds under __MACOSX/
+                        name = info.filename
+                        if info.is_dir() or name.startswith("__MACOSX/") or not name.lower().endswith(".pdf"):
+                            continue
+                        try:
+                            text = _extract_pdf_text(zf.read(name))
+                        except Exception as e:
+                            failed.append(f"{name} ({e})")
+                            continue
+                        # Image-only (scanned) PDFs have no text layer to send to the model
+                        if text.strip():
+                            batch_texts[name] = text
+                        else:
+                            failed.append(f"{name} (no text found)")
+                
+                st.success(f"✅ {len(batch_texts)} PDFs Processed Successfully")
+                if failed:
+                    st.error("Skipped unreadable PDFs:\n" + "\n".join(f"- {f}" for f in failed))
+            except Exception as e:
+                st.error(f"Error reading ZIP: {e}")
+
+    # OPTION 3: Simulated Text (Fastest for Demos)
     elif input_method == "Simulated Text":
         default_text = """
         Patient ID: P-99
@@ -55,48 +145,83 @@ with st.sidebar:
         """
         text_input = st.text_area("Medical Record", value=default_text, height=200)
 
-    # OPTION 3: Manual Entry (Fallback)
+    # OPTION 4: Manual Entry (Fallback)
     else:
         text_input = st.text_area("Paste Medical Record Here...", height=200)
 
     # The Trigger Button
     process_btn = st.button("🚀 Run AI Workflow")
 
+    # Forget every stored extraction (memory and disk), e.g. after changing the model
+    if st.button("🗑️ Clear cache"):
+        st.session_state.extraction_cache.clear()
+        get_disk_cache().clear()
+        st.success("Extraction cache cleared")
+
 
 # ===== MAIN AREA (OUTPUTS) =====
 if process_btn:
-    if not text_input:
+    if input_method == "Upload ZIP of PDFs":
+        if not batch_texts:
+            st.warning("⚠️ Please provide patient data first.")
+        else:
+            with st.spinner(f"🤖 AI Agent is analyzing {len(batch_texts)} records..."):
+                results = orchestrator.run_workflow_batch(list(batch_texts.values()))
+                st.session_state.pop("screening", None)
+                st.session_state.batch_screening = {"files": list(batch_texts), "results": results}
+    elif not text_input:
         st.warning("⚠️ Please provide patient data first.")
     else:
         with st.spinner("🤖 AI Agent is analyzing record..."):
-            # 1. Fetch Trials from "Database"
-            trials = st.session_state.db.get_trials()
-            
-            # 2. Run the Workflow (The Agent thinks here)
-            results = st.session_state.orchestrator.run_workflow(text_input, trials)
-            
-            # 3. Dashboard Metrics
-            st.success("Analysis Complete")
+            # 1. Run the Workflow (The Agent thinks here)
+            results = asyncio.run(orchestrator.run_workflow_async(text_input))
             
-            col1, col2 = st.columns(2)
-            col1.metric("Trials Checked", len(trials))
-            col2.metric("Eligible Matches", sum(1 for r in results if r.match_decision))
+            # 2. Keep results across reruns so detail toggles don't re-run the workflow
+            st.session_state.pop("batch_screening", None)
+            st.session_state.screening = {"results": results}
+
+batch_screening = st.session_state.get("batch_screening")
+if batch_screening:
+    st.success("Bulk Analysis Complete")
+    st.dataframe([
+        {
+            "File": name,
+            "Patient ID": results[0].patient_id if results else "",
+            "Eligible Trials": ", ".join(r.trial_id for r in results if r.match_decision),
+        }
+        for name, results in zip(batch_screening["files"], batch_screening["results"])
+    ])
+
+screening = st.session_state.get("screening")
+if screening:
+    results = screening["results"]
+
+    # 3. Dashboard Metrics
+    st.success("Analysis Complete")
+    
+    col1, col2 = st.columns(2)
+    col1.metric("Trials Checked", len(results))
+    col2.metric("Eligible Matches", sum(1 for r in results if r.match_decision))
+    
+    st.markdown("---")
+    
+    # 4. Detailed Results Cards
+    for res in results:
+        icon = "✅" if res.match_decision else "❌"
+        
+        with st.expander(f"{icon} Trial: {res.trial_id} ({res.confidence_score:.0%})"):
+            st.write(f"**Decision:** {res.match_decision}")
+
+            # Expander bodies always execute, so gate the formatting behind a toggle
+            if not st.checkbox("Show details", key=f"details_{res.trial_id}"):
+                continue
             
-            st.markdown("---")
+            if res.reasoning:
+                st.write("**Reasoning:**")
+                for tid, args in res.reasoning:
+                    st.markdown(f"- {REASONING_TEMPLATES[tid].format(*args)}")
             
-            # 4. Detailed Results Cards
-            for res in results:
-                icon = "✅" if res.match_decision else "❌"
-                status_color = ":green" if res.match_decision else ":red"
-                
-                with st.expander(f"{icon} Trial: {res.trial_id} ({res.confidence_score:.0%})"):
-                    st.write(f"**Decision:** {res.match_decision}")
-                    
-                    st.write("**Reasoning:**")
-                    for r in res.reasoning:
-                        st.markdown(f"- {r}")
-                    
-                    if res.missing_criteria:
-                        st.write("**Missing Criteria:**")
-                        for m in res.missing_criteria:
-                            st.markdown(f"- {m}")
\ No newline at end of file
+            if res.missing_criteria:
+                st.write("**Missing Criteria:**")
+                for tid, args in res.missing_criteria:
+                    st.markdown(f"- {REASONING_TEMPLATES[tid].format(*args)}")
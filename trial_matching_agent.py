@@ -1,15 +1,28 @@
 import os
+import re
+import asyncio
 import json
+import time
+import hashlib
 import logging
-from datetime import datetime
-from typing import Dict, List, Optional
-from pydantic import BaseModel, Field, validator
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from pydantic import BaseModel, Field, PrivateAttr, validator
 from dotenv import load_dotenv
 
 # --- GOOGLE GEMINI IMPORTS ---
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
+
+# orjson parses the small LLM responses 2-3x faster; stdlib json is the fallback
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # Load environment variables (API Key)
 load_dotenv()
@@ -45,32 +58,73 @@ class ClinicalTrial(BaseModel):
     excluded_medications: List[str] = Field(default_factory=list)
     locations: List[str]
 
+    # Lowercased once at load so matching never re-lowers trial strings
+    _condition_lower: str = PrivateAttr(default="")
+    _locations_lower: List[str] = PrivateAttr(default_factory=list)
+
+    def model_post_init(self, __context):
+        self._condition_lower = self.condition.lower()
+        self._locations_lower = [site.lower() for site in self.locations]
+
+# Reasoning is stored as (template_id, args) and only formatted when a trial is displayed
+REASONING_TEMPLATES = {
+    0: "✓ Age {} within range",
+    1: "✓ Diagnosis match: {}",
+    2: "✓ Location match: {}",
+    3: "Age {} outside {}-{}",
+    4: "Diagnosis mismatch: {} != {}",
+    5: "Location {} not in trial sites {}",
+}
+
 class MatchResult(BaseModel):
     patient_id: str
     trial_id: str
     match_decision: bool
     confidence_score: float
-    reasoning: List[str]
-    missing_criteria: List[str]
-    timestamp: datetime = Field(default_factory=datetime.now)
+    reasoning: List[Tuple[int, tuple]]
+    missing_criteria: List[Tuple[int, tuple]]
+    # Set by the matcher from one clock read per screening, not one per result
+    timestamp: Optional[datetime] = None
 
-# ===== AGENTS =====
+# ===== PROMPTS =====
 
-class PatientExtractionAgent:
-    def __init__(self):
-        # Using the specific 2.5 Flash model available in your list
-        self.llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0)
+EXTRACTION_MODEL = "gemini-2.5-flash"
 
-    def extract_from_text(self, medical_text: str) -> PatientData:
-        prompt_text = """
-        You are a medical data extractor. Extract patient data from the text below.
+# Static prefix: identical on every call, so (at 1024+ tokens) it earns Gemini's implicit
+# prefix caching. Keep it free of anything that varies per call (timestamps, session ids);
+# the medical record always goes last.
+EXTRACTION_RULES = """
+        You are a medical data extractor working for a clinical trial screening team.
+        Your only job is to read an unstructured medical record and turn it into one structured
+        patient object. Other systems make the eligibility decision; you must never judge
+        eligibility, add commentary or guess at information that is not in the record.
         Return ONLY raw JSON. Do not use Markdown formatting (no ```json).
         
+        GENERAL RULES:
+        - Copy identifiers exactly as written (keep prefixes, dashes and letter case).
+        - Age is a whole number of years. If only a date of birth and a visit date are given,
+          compute the age on the visit date. If an age is given as "52 y/o" or "52yo", use 52.
+        - Diagnosis is the primary condition being treated, written as a short clinical name
+          (e.g. "Type 2 Diabetes", "Hypertension"). Prefer the full name over abbreviations
+          such as "T2DM" or "HTN". If several conditions are listed, use the primary one.
+        - Medications are the drug names only, without doses, routes or frequencies
+          ("Metformin 500 mg BID" becomes "Metformin"). Keep one entry per drug.
+        - Location is the city where the patient is being seen, without street address,
+          postal code or clinic name. Keep the province or state only if it is part of the
+          city text in the record (e.g. "Toronto, ON").
+        - If a field is genuinely missing, use an empty string for text fields, an empty
+          list for medications and an empty object for biomarkers. Never invent values.
+        
         CRITICAL RULES FOR BIOMARKERS:
         - Values must be NUMBERS (floats) only.
         - DO NOT include fractions or strings like "120/80".
         - If you see Blood Pressure (e.g. "160/95"), split it into two fields: "SystolicBP" (160) and "DiastolicBP" (95).
-        
+        - Drop units ("8.2%" becomes 8.2, "195 mg/dL" becomes 195).
+        - Use the biomarker name as written in the record, without units (e.g. "HbA1c", "LDL").
+        - If a biomarker is reported several times, use the most recent value.
+        """
+
+EXTRACTION_SCHEMA = """
         Fields required:
         - patient_id (string)
         - age (integer)
@@ -78,117 +132,483 @@ class PatientExtractionAgent:
         - biomarkers (dictionary of floats)
         - medications (list of strings)
         - location (string)
+        """
+
+EXTRACTION_EXAMPLES = """
+        EXAMPLES (input record followed by the exact output expected):
+
+        Example 1
+        Record:
+        Patient ID: P-12
+        Age: 52
+        Diagnosis: Type 2 Diabetes
+        Biomarkers: HbA1c: 8.2
+        Medications: Metformin
+        Location: Toronto
+        Output:
+        {"patient_id": "P-12", "age": 52, "diagnosis": "Type 2 Diabetes", "biomarkers": {"HbA1c": 8.2}, "medications": ["Metformin"], "location": "Toronto"}
+
+        Example 2
+        Record:
+        Pt #A-4471, 67 y/o male seen in clinic (Vancouver). Long-standing HTN, poorly controlled.
+        BP today 160/95. Currently on Lisinopril 20 mg daily and Amlodipine 5 mg daily.
+        Output:
+        {"patient_id": "A-4471", "age": 67, "diagnosis": "Hypertension", "biomarkers": {"SystolicBP": 160.0, "DiastolicBP": 95.0}, "medications": ["Lisinopril", "Amlodipine"], "location": "Vancouver"}
+
+        Example 3
+        Record:
+        MRN 000981 | Female, 45 | Montreal General Hospital
+        Dx: T2DM, dyslipidemia. Labs: HbA1c 9.1%, fasting glucose 195 mg/dL, LDL 3.4 mmol/L.
+        Rx: Insulin glargine 20 units qHS, Metformin 1000 mg BID, Atorvastatin 40 mg.
+        Output:
+        {"patient_id": "000981", "age": 45, "diagnosis": "Type 2 Diabetes", "biomarkers": {"HbA1c": 9.1, "fasting glucose": 195.0, "LDL": 3.4}, "medications": ["Insulin glargine", "Metformin", "Atorvastatin"], "location": "Montreal"}
+
+        Example 4
+        Record:
+        Patient ID: C-300
+        Date of birth: 1990-03-14, visit date: 2024-03-01
+        Diagnosis: Asthma (moderate persistent)
+        No current medications. No labs on file.
+        Location: Calgary, AB
+        Output:
+        {"patient_id": "C-300", "age": 33, "diagnosis": "Asthma", "biomarkers": {}, "medications": [], "location": "Calgary, AB"}
+
+        Example 5
+        Record:
+        ID: P-77. 71-year-old with hypertension and type 2 diabetes, referred for BP management.
+        Vitals: BP 142/88 (repeat 138/84). HbA1c 7.4. Meds: hydrochlorothiazide.
+        Seen at Ottawa Heart Institute, 40 Ruskin St, Ottawa.
+        Output:
+        {"patient_id": "P-77", "age": 71, "diagnosis": "Hypertension", "biomarkers": {"SystolicBP": 138.0, "DiastolicBP": 84.0, "HbA1c": 7.4}, "medications": ["Hydrochlorothiazide"], "location": "Ottawa"}
+
+        Example 6
+        Record:
+        REFERRAL NOTE
+        Name withheld. Study screening number: SCR-2051. Age 58.
+        Primary diagnosis: Type 2 Diabetes Mellitus; secondary: obesity (BMI 34.2).
+        HbA1c 8.8 (Jan), 8.4 (Apr). eGFR 72. Currently taking Empagliflozin 10 mg and Semaglutide 0.5 mg weekly.
+        Home clinic: Toronto Western, Toronto, ON M5T 2S8.
+        Output:
+        {"patient_id": "SCR-2051", "age": 58, "diagnosis": "Type 2 Diabetes", "biomarkers": {"BMI": 34.2, "HbA1c": 8.4, "eGFR": 72.0}, "medications": ["Empagliflozin", "Semaglutide"], "location": "Toronto, ON"}
+        """
+
+EXTRACTION_PREFIX = EXTRACTION_RULES + EXTRACTION_SCHEMA + EXTRACTION_EXAMPLES
+
+# Part of every extraction cache key, so editing the prompt invalidates old results
+EXTRACTION_PROMPT_VERSION = hashlib.sha1(EXTRACTION_PREFIX.encode()).hexdigest()[:8]
+
+EXTRACTION_BATCH_INSTRUCTIONS = """
+        You will receive several medical records, numbered [0], [1], ... and separated by "---".
+        Return ONLY a raw JSON array with one object per record, in the same order as the records.
+        """
+
+# Markdown code fences Gemini sometimes wraps around JSON, stripped in a single pass
+_FENCE_RE = re.compile(r"```(?:json)?")
 
+# Records per batched extraction call; bounded by the model's context length
+EXTRACTION_BATCH_SIZE = 20
+
+# Most recent extractions kept per cache (oldest evicted first)
+EXTRACTION_CACHE_SIZE = 256
+
+def build_llm() -> ChatGoogleGenerativeAI:
+    # JSON mode: Gemini returns bare JSON, so fences are the exception rather than the rule
+    return ChatGoogleGenerativeAI(
+        model=EXTRACTION_MODEL, temperature=0, response_mime_type="application/json"
+    )
+
+def _template_safe(text: str) -> str:
+    # The few-shot JSON contains braces, which ChatPromptTemplate would read as variables
+    return text.replace("{", "{{").replace("}", "}}")
+
+# ===== PERSISTENT CACHE =====
+
+# Holds extracted patient data unencrypted; point it somewhere access-controlled
+EXTRACTION_DB_PATH = os.getenv("EXTRACTION_CACHE_PATH", "extraction_cache.sqlite3")
+EXTRACTION_DB_TTL = timedelta(days=7)
+
+class ExtractionDiskCache:
+    # SQLite-backed second level behind the in-memory extraction cache; survives restarts
+    # and is shared by every session. One connection guarded by a lock (Streamlit runs
+    # sessions on separate threads).
+    def __init__(self, path: str = EXTRACTION_DB_PATH, ttl: timedelta = EXTRACTION_DB_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS extractions "
+                "(key TEXT PRIMARY KEY, data TEXT NOT NULL, created REAL NOT NULL)"
+            )
+        self.expire()
+
+    def get(self, key: str) -> Optional[PatientData]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM extractions WHERE key = ? AND created >= ?",
+                (key, time.time() - self.ttl.total_seconds()),
+            ).fetchone()
+        if row is None:
+            return None
+
+        # The file lives outside the process, so re-validate and drop rows that no longer parse
+        try:
+            return PatientData.model_validate_json(row[0])
+        except Exception as e:
+            logger.warning(f"Dropping invalid extraction cache entry {key}: {e}")
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM extractions WHERE key = ?", (key,))
+            return None
+
+    def set(self, key: str, patient: PatientData):
+        # Only called with patients validated in _to_patient
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (key, data, created) VALUES (?, ?, ?)",
+                (key, patient.model_dump_json(), time.time()),
+            )
+
+    def expire(self):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM extractions WHERE created < ?",
+                (time.time() - self.ttl.total_seconds(),),
+            )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM extractions")
+
+# ===== AGENTS =====
+
+class PatientExtractionAgent:
+    def __init__(self, llm: Optional[ChatGoogleGenerativeAI] = None,
+                 cache: Optional[Dict[str, PatientData]] = None,
+                 disk_cache: Optional[ExtractionDiskCache] = None):
+        # Using the specific 2.5 Flash model available in your list; callers may share one client
+        self.llm = llm if llm is not None else build_llm()
+
+        # Full prompt chain, built once and reused for every extraction
+        self._prompt_text = _template_safe(EXTRACTION_PREFIX) + """
         Medical Record:
         {text}
         """
-        prompt = ChatPromptTemplate.from_template(prompt_text)
-        chain = prompt | self.llm
+        self._prompt = ChatPromptTemplate.from_template(self._prompt_text)
+        self.chain = self._prompt | self.llm
+
+        # Same prefix for bulk screening: many records in, one JSON array out
+        self._batch_prompt_text = _template_safe(EXTRACTION_PREFIX) + EXTRACTION_BATCH_INSTRUCTIONS + """
+        Records:
+        {text}
+        """
+        self.batch_chain = ChatPromptTemplate.from_template(self._batch_prompt_text) | self.llm
+
+        # Results keyed on a hash of the normalized record. Pass a longer-lived dict
+        # (e.g. Streamlit session state) to keep hits across reruns.
+        self._cache = cache if cache is not None else {}
+        # Optional persistent level checked on in-memory misses
+        self._disk_cache = disk_cache
+
+    @staticmethod
+    def _normalize(t: str) -> str:
+        # Drop punctuation-only lines and collapse all whitespace; case is kept because
+        # identifiers are copied exactly as written
+        lines = [line for line in t.splitlines() if re.search(r"\w", line)]
+        return " ".join(" ".join(lines).split())
+
+    def _log_cache_usage(self, response):
+        # Confirms the static prefix is actually being served from Gemini's implicit cache
+        usage = getattr(response, "usage_metadata", None)
+        if not usage:
+            return
+        cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+        total = usage.get("input_tokens", 0)
+        logger.info(f"Prompt cache: {cached}/{total} input tokens served from cache")
+
+    def _generate(self, medical_text: str) -> str:
+        response = self.chain.invoke({"text": medical_text})
+        self._log_cache_usage(response)
+        return response.content
+
+    async def _agenerate(self, medical_text: str) -> str:
+        response = await self.chain.ainvoke({"text": medical_text})
+        self._log_cache_usage(response)
+        return response.content
+
+    def _lookup(self, medical_text: str):
+        # Identical records (re-runs, toggled trials) never reach the LLM twice
+        digest = hashlib.sha1(self._normalize(medical_text).encode()).hexdigest()
+        key = f"{EXTRACTION_PROMPT_VERSION}:{digest}"
+        patient = self._cache.pop(key, None)
+        if patient is not None:
+            self._cache[key] = patient
+        elif self._disk_cache is not None:
+            patient = self._disk_cache.get(key)
+            if patient is not None:
+                self._remember(key, patient)
+        return key, patient
+
+    def _remember(self, key: str, patient: PatientData):
+        # In-memory level, evicting the least recently used
+        if len(self._cache) >= EXTRACTION_CACHE_SIZE:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[key] = patient
+
+    def _load_json(self, raw_content: str):
+        # 2. Clean the cleanup (Remove markdown if Gemini adds it)
+        clean_content = _FENCE_RE.sub("", raw_content).strip()
+        
+        # 3. Parse JSON manually
+        return _json_loads(clean_content)
+
+    def _parse(self, raw_content: str, key: str) -> PatientData:
+        return self._to_patient(self._load_json(raw_content), key)
+
+    def _to_patient(self, result: dict, key: str) -> PatientData:
+        # 4. Add defaults if missing
+        if "biomarkers" not in result: result["biomarkers"] = {}
+        if "medications" not in result: result["medications"] = []
         
+        # 5. LLM output is untrusted: full validation (types, coercion, age range)
+        patient = PatientData.model_validate(result)
+
+        # 6. Cache successful extractions only, in memory and on disk
+        self._remember(key, patient)
+        if self._disk_cache is not None:
+            self._disk_cache.set(key, patient)
+        return patient
+
+    def _fallback(self, e: Exception, raw_content: Optional[str]) -> PatientData:
+        # Print error to terminal for debugging
+        print(f"\n❌ FULL ERROR: {e}")
+        print(f"❌ RAW AI OUTPUT: {raw_content if raw_content is not None else 'No output'}\n")
+        return self._error_patient(e)
+
+    def _error_patient(self, e: Exception) -> PatientData:
+        # Return error data so UI doesn't crash completely
+        return PatientData(
+            patient_id="ERR", age=0, diagnosis=f"Failed: {str(e)[:50]}", location="Unknown"
+        )
+
+    def extract_from_text(self, medical_text: str) -> PatientData:
+        key, patient = self._lookup(medical_text)
+        if patient is not None:
+            return patient
+
+        raw_content = None
         try:
             # 1. Get raw string response
-            response = chain.invoke({"text": medical_text})
-            raw_content = response.content
-            
-            # 2. Clean the cleanup (Remove markdown if Gemini adds it)
-            clean_content = raw_content.replace("```json", "").replace("```", "").strip()
-            
-            # 3. Parse JSON manually
-            result = json.loads(clean_content)
-            
-            # 4. Add defaults if missing
-            if "biomarkers" not in result: result["biomarkers"] = {}
-            if "medications" not in result: result["medications"] = []
-            
-            return PatientData(**result)
-            
+            raw_content = self._generate(medical_text)
+            return self._parse(raw_content, key)
         except Exception as e:
-            # Print error to terminal for debugging
-            print(f"\n❌ FULL ERROR: {e}")
-            print(f"❌ RAW AI OUTPUT: {raw_content if 'raw_content' in locals() else 'No output'}\n")
-            
-            # Return error data so UI doesn't crash completely
-            return PatientData(
-                patient_id="ERR", age=0, diagnosis=f"Failed: {str(e)[:50]}", location="Unknown"
-            )
+            return self._fallback(e, raw_content)
+
+    async def aextract_from_text(self, medical_text: str) -> PatientData:
+        key, patient = self._lookup(medical_text)
+        if patient is not None:
+            return patient
+
+        raw_content = None
+        try:
+            # 1. Get raw string response without blocking the event loop
+            raw_content = await self._agenerate(medical_text)
+            return self._parse(raw_content, key)
+        except Exception as e:
+            return self._fallback(e, raw_content)
+
+    def extract_batch(self, medical_texts: List[str]) -> List[PatientData]:
+        patients: List[Optional[PatientData]] = []
+        pending = []  # (position, cache key, text) for records that still need the LLM
+        for i, text in enumerate(medical_texts):
+            key, patient = self._lookup(text)
+            patients.append(patient)
+            if patient is None:
+                pending.append((i, key, text))
+
+        # One LLM round-trip per chunk of records instead of one per record
+        for start in range(0, len(pending), EXTRACTION_BATCH_SIZE):
+            chunk = pending[start:start + EXTRACTION_BATCH_SIZE]
+            records = "\n---\n".join(f"[{n}] {text}" for n, (_, _, text) in enumerate(chunk))
+
+            raw_content = None
+            try:
+                response = self.batch_chain.invoke({"text": records})
+                self._log_cache_usage(response)
+                raw_content = response.content
+                results = self._load_json(raw_content)
+                if not isinstance(results, list) or len(results) != len(chunk):
+                    raise ValueError(f"Expected a JSON array of {len(chunk)} records")
+            except Exception as e:
+                # The whole reply is printed once per chunk, not once per record
+                error_patient = self._fallback(e, raw_content)
+                for i, _, _ in chunk:
+                    patients[i] = error_patient
+                continue
+
+            failed = False
+            for n, ((i, key, _), result) in enumerate(zip(chunk, results)):
+                try:
+                    patients[i] = self._to_patient(result, key)
+                except Exception as e:
+                    logger.error(f"Batch extraction failed for record [{n}]: {e}")
+                    patients[i] = self._error_patient(e)
+                    failed = True
+            if failed:
+                logger.error(f"Raw batch reply: {raw_content}")
+        return patients
 
 class TrialMatchingAgent:
-    def evaluate_match(self, patient: PatientData, trial: ClinicalTrial) -> MatchResult:
+    def _build_result(self, patient: PatientData, trial: ClinicalTrial,
+                      diagnosis_ok: bool, age_ok: bool, location_ok: bool,
+                      timestamp: datetime) -> MatchResult:
         reasoning = []
         missing = []
-        checks = 0
+        checks = 3
         passed = 0
 
         # Logic 1: Diagnosis (Flexible string match)
-        checks += 1
-        if trial.condition.lower() in patient.diagnosis.lower():
-            reasoning.append(f"✓ Diagnosis match: {patient.diagnosis}")
+        if diagnosis_ok:
+            reasoning.append((1, (patient.diagnosis,)))
             passed += 1
         else:
-            missing.append(f"Diagnosis mismatch: {patient.diagnosis} != {trial.condition}")
+            missing.append((4, (patient.diagnosis, trial.condition)))
 
         # Logic 2: Age
-        checks += 1
-        if trial.age_min <= patient.age <= trial.age_max:
-            reasoning.append(f"✓ Age {patient.age} within range")
+        if age_ok:
+            reasoning.append((0, (patient.age,)))
             passed += 1
         else:
-            missing.append(f"Age {patient.age} outside {trial.age_min}-{trial.age_max}")
+            missing.append((3, (patient.age, trial.age_min, trial.age_max)))
 
         # Logic 3: Location (Smart substring match)
-        checks += 1
-        # Checks if "Toronto" is inside "Toronto, ON"
-        location_match = any(site.lower() in patient.location.lower() for site in trial.locations)
-        
-        if location_match:
-            reasoning.append(f"✓ Location match: {patient.location}")
+        if location_ok:
+            reasoning.append((2, (patient.location,)))
             passed += 1
         else:
-            missing.append(f"Location {patient.location} not in trial sites {trial.locations}")
+            missing.append((5, (patient.location, trial.locations)))
 
         # Calculate Score
-        confidence = passed / checks if checks > 0 else 0
+        confidence = passed / checks
         
         # STRICT MODE: Patient must match ALL criteria (100%) to be eligible
         decision = (confidence == 1.0)
 
-        return MatchResult(
+        # Every field is computed above, so skip validation
+        return MatchResult.model_construct(
             patient_id=patient.patient_id,
             trial_id=trial.trial_id,
             match_decision=decision,
             confidence_score=confidence,
             reasoning=reasoning,
-            missing_criteria=missing
+            missing_criteria=missing,
+            timestamp=timestamp
         )
 
+    # diag_lower / loc_lower are the patient's diagnosis and location lowercased once
+    # per workflow by the caller, rather than once per trial.
+
+    def evaluate_match(self, patient: PatientData, diag_lower: str, loc_lower: str,
+                       trial: ClinicalTrial, timestamp: Optional[datetime] = None) -> MatchResult:
+        # Single-trial fallback; evaluate_batch is the hot path for whole databases
+        diagnosis_ok = trial._condition_lower in diag_lower
+        age_ok = trial.age_min <= patient.age <= trial.age_max
+        # Checks if "Toronto" is inside "Toronto, ON"
+        location_ok = any(site in loc_lower for site in trial._locations_lower)
+        return self._build_result(patient, trial, diagnosis_ok, age_ok, location_ok,
+                                  timestamp or datetime.now())
+
+    def evaluate_batch(self, patient: PatientData, diag_lower: str, loc_lower: str,
+                       db: "TrialDatabase", timestamp: Optional[datetime] = None) -> List[MatchResult]:
+        timestamp = timestamp or datetime.now()
+
+        # Same three checks as evaluate_match, computed for every trial in one NumPy pass
+        diagnosis_ok = np.char.find(diag_lower, db.cond_lower) >= 0
+        age_ok = (db.age_min_arr <= patient.age) & (patient.age <= db.age_max_arr)
+
+        # Any site of trial i matching == running hit count grows across its CSR slice
+        site_hits = np.char.find(loc_lower, db.loc_flat_lower) >= 0
+        hit_counts = np.concatenate(([0], np.cumsum(site_hits)))
+        location_ok = hit_counts[db.loc_offsets[1:]] > hit_counts[db.loc_offsets[:-1]]
+
+        return [
+            self._build_result(patient, trial, bool(d), bool(a), bool(l), timestamp)
+            for trial, d, a, l in zip(db.trials, diagnosis_ok, age_ok, location_ok)
+        ]
+
 # ===== ORCHESTRATOR & DATABASE =====
 
 class WorkflowOrchestrator:
-    def __init__(self):
-        self.extractor = PatientExtractionAgent()
+    def __init__(self, extraction_cache: Optional[Dict[str, PatientData]] = None,
+                 db: Optional["TrialDatabase"] = None,
+                 llm: Optional[ChatGoogleGenerativeAI] = None,
+                 disk_cache: Optional[ExtractionDiskCache] = None):
+        self.extractor = PatientExtractionAgent(llm=llm, cache=extraction_cache, disk_cache=disk_cache)
         self.matcher = TrialMatchingAgent()
-        self.history = []
+        self.db = db if db is not None else TrialDatabase()
 
-    def run_workflow(self, text: str, trials: List[ClinicalTrial]):
+    def _match(self, patient: PatientData, trials: List[ClinicalTrial]) -> List[MatchResult]:
+        # The default database is indexed once at load; ad-hoc trial lists get indexed here
+        db = self.db if trials is self.db.trials else TrialDatabase(trials)
+        diag_lower = patient.diagnosis.lower()
+        loc_lower = patient.location.lower()
+        # One clock read stamps every result
+        now = datetime.now()
+        return self.matcher.evaluate_batch(patient, diag_lower, loc_lower, db, timestamp=now)
+
+    def run_workflow(self, text: str, trials: Optional[List[ClinicalTrial]] = None):
         patient = self.extractor.extract_from_text(text)
-        results = []
-        for trial in trials:
-            res = self.matcher.evaluate_match(patient, trial)
-            results.append(res)
-        
-        self.history.append({"time": datetime.now(), "matches": len(results)})
-        return results
+        if trials is None:
+            trials = self.db.get_trials()
+        return self._match(patient, trials)
+
+    def run_workflow_batch(self, texts: List[str], trials: Optional[List[ClinicalTrial]] = None):
+        # Bulk screening: one result list per record, extracted in batched LLM calls
+        patients = self.extractor.extract_batch(texts)
+        if trials is None:
+            trials = self.db.get_trials()
+        return [self._match(patient, trials) for patient in patients]
+
+    async def run_workflow_async(self, text: str, trials: Optional[List[ClinicalTrial]] = None):
+        # Extraction (LLM) and the trial fetch are independent I/O, so overlap them
+        if trials is None:
+            patient, trials = await asyncio.gather(
+                self.extractor.aextract_from_text(text), self.db.aget_trials()
+            )
+        else:
+            patient = await self.extractor.aextract_from_text(text)
+        return self._match(patient, trials)
 
 class TrialDatabase:
+    def __init__(self, trials: Optional[List[ClinicalTrial]] = None):
+        self.trials = trials if trials is not None else self._load_trials()
+
+        # Structure-of-arrays view of the trials for TrialMatchingAgent.evaluate_batch
+        self.age_min_arr = np.array([t.age_min for t in self.trials], dtype=np.int16)
+        self.age_max_arr = np.array([t.age_max for t in self.trials], dtype=np.int16)
+        self.cond_lower = np.array([t._condition_lower for t in self.trials], dtype=str)
+
+        # Locations flattened CSR-style: trial i owns loc_flat_lower[loc_offsets[i]:loc_offsets[i + 1]]
+        self.loc_offsets = np.cumsum([0] + [len(t.locations) for t in self.trials])
+        self.loc_flat_lower = np.array(
+            [site for t in self.trials for site in t._locations_lower], dtype=str
+        )
+
     def get_trials(self):
+        return self.trials
+
+    async def aget_trials(self):
+        # Runs in a worker thread so a real (blocking) DB driver won't stall the event loop
+        return await asyncio.to_thread(self.get_trials)
+
+    def _load_trials(self):
         # Dummy data simulating SQL DB
         return [
-            ClinicalTrial(
+            ClinicalTrial.model_construct(
                 trial_id="NCT001", title="Diabetes Phase 3", condition="Diabetes",
                 phase="Phase 3", age_min=18, age_max=75,
                 locations=["Toronto", "Montreal"], excluded_medications=["Insulin"]
             ),
-             ClinicalTrial(
+             ClinicalTrial.model_construct(
                 trial_id="NCT002", title="Hypertension Study", condition="Hypertension",
                 phase="Phase 2", age_min=40, age_max=80,
                 locations=["Vancouver"], excluded_medications=[]